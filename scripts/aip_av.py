@@ -1,7 +1,7 @@
 ﻿"""Purpose: Creates AIPs from folders of digital audiovisual objects that are ready for ingest into the digital
 preservation system (ARCHive). Works for all Russell audiovisual objects and Hargrett oral history collections.
 
-Dependencies: bagit.py, md5deep, mediainfo, saxon, xmllint
+Dependencies: bagit.py, mediainfo, saxon (or optionally saxonche), xmllint
 
 Prior to running the script:
 
@@ -29,8 +29,13 @@ The script also generates a log of the AIPs processed and their final status, ei
 
 # Script usage: python3 'path/aip_av.py' 'path/aips_directory'
 
+import bagit
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import csv
 import datetime
+from functools import lru_cache
+import hashlib
 import os
 import pandas as pd
 import shutil
@@ -38,9 +43,53 @@ import subprocess
 import sys
 from configuration import *
 
+# saxonche (optional) runs Saxon inside Python, so the stylesheet is compiled once per worker process
+# instead of starting Java and compiling the stylesheet again for every AIP.
+# If it is not installed, the Saxon jar in configuration.py is run with Java instead.
+try:
+    from saxonche import PySaxonApiError, PySaxonProcessor
+except ImportError:
+    PySaxonProcessor = None
+
+# lxml (optional) validates the preservation.xml within Python, so the schema is read once per worker process
+# instead of starting xmllint and reading the schema again for every AIP.
+# If it is not installed, xmllint is used instead.
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+# Start of the command for running the Saxon jar with Java, when saxonche is not installed.
+# The JVM options shorten Java's startup, which is most of the time for transforming one small mediainfo.xml:
+# only the quick compiler is used (TieredStopAtLevel=1) and the simplest garbage collector (UseSerialGC).
+SAXON_COMMAND = ['java', '-XX:TieredStopAtLevel=1', '-XX:+UseSerialGC', '-cp', SAXON, 'net.sf.saxon.Transform']
+
+# File extensions to keep in an AIP. Files with any other extension are deleted by delete_files().
+# This is a frozenset so each file's extension is checked with one lookup instead of comparing to every extension.
+KEEP_EXTENSIONS = frozenset({'.dv', '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.wav', '.pdf', '.xml'})
+
+# Items in the AIPs directory that are not AIP folders: .DS_Store, the metadata.csv, and the script outputs.
+# These are not included when comparing the AIPs directory to the metadata.csv.
+SKIP_ITEMS = frozenset({'.DS_Store', 'metadata.csv', 'aips-to-ingest', 'errors', 'log.csv', 'mediainfo-xml',
+                        'preservation-xml'})
+
+# One row of the metadata.csv, with the columns in the required order.
+# This is defined at the module level so rows can be pickled and given to the worker processes.
+AIPRow = namedtuple('AIPRow', ['Department', 'Collection', 'Folder', 'AIP_ID', 'Title', 'Version'])
+
+# Start of the packaged AIP filenames for each department, for sorting them into the department manifests.
+DEPARTMENT_PREFIXES = {'har': 'hargrett', 'rbrl': 'russell'}
+
+# Log rows for the AIP being processed by this worker process.
+# These are returned by process_aip() and saved to the log file by the main process.
+log_rows = []
+
 
 def log(aip, message):
-    """Save the AIP ID and a message to the log file, a CSV in the AIPs directory
+    """Save the AIP ID and a message for the log file, a CSV in the AIPs directory
+
+    The AIPs are processed in separate worker processes, so the row is kept in log_rows
+    and returned to the main process to save to the log file, rather than each worker writing to the same file.
 
     Parameters:
         aip: AIP ID
@@ -49,9 +98,7 @@ def log(aip, message):
     Returns: None
     """
 
-    with open('log.csv', 'a', newline='') as log_file:
-        log_writer = csv.writer(log_file)
-        log_writer.writerow([aip, message])
+    log_rows.append([aip, message])
 
 
 def move_error(error_name, aip_folder):
@@ -69,14 +116,15 @@ def move_error(error_name, aip_folder):
     """
 
     # Makes the error folder, if it does not already exist, and moves the AIP to that folder.
-    if not os.path.exists(f'errors/{error_name}'):
-        os.makedirs(f'errors/{error_name}')
+    # exist_ok is used instead of checking if the folder exists first,
+    # since another worker process may make the same error folder at the same time.
+    os.makedirs(f'errors/{error_name}', exist_ok=True)
     os.replace(aip_folder, f'errors/{error_name}/{aip_folder}')
 
     # Adds the error to a log in the AIPs directory.
-    # If the error is from bag, calculates the AIP ID (everything except _bag).
+    # If the error is from bag validation or tar and zip, calculates the AIP ID (everything except _bag).
     # Otherwise, aip_folder is already the AIP ID.
-    if error_name == 'bag_invalid':
+    if error_name in ('bag_invalid', 'tar_zip_failed'):
         log(aip_folder[:-4], error_name)
     else:
         log(aip_folder, error_name)
@@ -130,56 +178,77 @@ def metadata_csv(aips_dir):
         error_list.append("Missing the required file 'metadata.csv' in the AIPS directory.")
         return None, error_list
 
-    # Reads the metadata.csv into a pandas dataframe.
-    metadata_df = pd.read_csv(csv_path)
-
-    # Checks the column names are correct.
-    # If not, returns the error without checking column contents, since the correct column cannot be found.
-    expected_columns = ['Department', 'Collection', 'Folder', 'AIP_ID', 'Title', 'Version']
-    if not metadata_df.columns.to_list() == expected_columns:
+    # Checks the column names are correct, reading only the header of metadata.csv.
+    # If not, returns the error without reading the rest of the file, since the correct column cannot be found.
+    expected_columns = list(AIPRow._fields)
+    csv_columns = pd.read_csv(csv_path, nrows=0).columns.to_list()
+    if not csv_columns == expected_columns:
         error_list.append(f"The columns in the metadata.csv do not match the required values and/or order."
                           f"\n  Required: {', '.join(expected_columns)}"
-                          f"\n  Current: {', '.join(metadata_df.columns.to_list())}")
+                          f"\n  Current: {', '.join(csv_columns)}")
         return None, error_list
 
+    # Reads the metadata.csv into a pandas dataframe.
+    # Every value is read as text, so values are used exactly as typed (for example, an AIP ID of only numbers is not
+    # made into a number) and blank cells are empty text instead of NaN.
+    metadata_df = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+
     # Checks the columns match ARCHive, based on a list in configuration.py
-    departments = metadata_df['Department'].unique()
-    dept_error = []
-    for department in departments:
-        if department not in GROUPS:
-            dept_error.append(department)
+    dept_error = metadata_df.loc[~metadata_df['Department'].isin(GROUPS), 'Department'].unique().tolist()
     if len(dept_error) > 0:
         error_list.append(f"Department(s) not in ARCHive group list: {'; '.join(dept_error)}.")
 
     # Checks that no AIP (based on Folder column) is in metadata.csv more than once.
-    dup_folder_df = metadata_df[metadata_df.duplicated('Folder')]
-    dup_error = []
-    if not dup_folder_df.empty:
-        for aip_folder in dup_folder_df['Folder'].unique().tolist():
-            dup_error.append(aip_folder)
+    dup_error = metadata_df.loc[metadata_df.duplicated('Folder'), 'Folder'].unique().tolist()
     if len(dup_error) > 0:
         error_list.append(f"Folder(s) in metadata.csv more than once: {'; '.join(dup_error)}.")
 
-    # Makes a dataframe of folders in the aips_directory (current directory), for comparing to the metadata.csv.
-    # Ignores .DS_Store, which may be in aips_directory but should not be in metadata.csv.
-    aips_dir_list = []
-    for item in os.listdir('.'):
-        if item not in ('.DS_Store', 'metadata.csv'):
-            aips_dir_list.append(item)
-    aips_dir_df = pd.DataFrame(aips_dir_list, columns=['Folder_Dir'])
+    # Checks that no AIP ID is in metadata.csv more than once.
+    # The AIPs are processed at the same time, so two folders with the same AIP ID would be renamed to the same folder.
+    dup_id_error = metadata_df.loc[metadata_df.duplicated('AIP_ID'), 'AIP_ID'].unique().tolist()
+    if len(dup_id_error) > 0:
+        error_list.append(f"AIP ID(s) in metadata.csv more than once: {'; '.join(dup_id_error)}.")
+
+    # Makes a set of folders in the aips_directory (current directory), for comparing to the metadata.csv.
+    # Ignores the items in SKIP_ITEMS, which may be in aips_directory but should not be in metadata.csv.
+    with os.scandir('.') as entries:
+        aips_dir_folders = {entry.name for entry in entries if entry.name not in SKIP_ITEMS}
 
     # Checks the folders in the aips_directory match the folders in metadata.csv.
-    compare_df = metadata_df.merge(aips_dir_df, left_on='Folder', right_on='Folder_Dir', how='outer', indicator=True)
-    csv_only = compare_df[compare_df['_merge'] == 'left_only']['Folder'].unique().tolist()
+    # Uses set differences, which are sorted so the errors list the folders in the same order every time.
+    csv_folders = set(metadata_df['Folder'])
+    csv_only = sorted(csv_folders - aips_dir_folders)
     if len(csv_only) > 0:
         error_list.append(f"Folder(s) in metadata.csv and not the aips_directory: {'; '.join(csv_only)}.")
-    dir_only = compare_df[compare_df['_merge'] == 'right_only']['Folder_Dir'].tolist()
+    dir_only = sorted(aips_dir_folders - csv_folders)
     if len(dir_only) > 0:
         error_list.append(f"Folder(s) in aips_directory and not in the metadata.csv: {'; '.join(dir_only)}.")
 
     return metadata_df, error_list
 
 
+def scan_files(folder):
+    """Find every file in a folder, including in its subfolders
+
+    Uses os.scandir() instead of os.walk(), since each entry already has its path and if it is a folder,
+    which saves a stat and building the path for every file.
+    Every entry in a folder is read before any are returned, so the caller can safely delete the files.
+
+    Parameters:
+        folder: path to the folder
+
+    Returns: a generator of os.DirEntry objects, one for each file
+    """
+
+    with os.scandir(folder) as entries:
+        entry_list = list(entries)
+    for entry in entry_list:
+        if entry.is_dir(follow_symlinks=False):
+            yield from scan_files(entry.path)
+        else:
+            yield entry
+
+
 def delete_files(aip):
     """Deletes unwanted files based on their file extension.
 
@@ -190,15 +259,17 @@ def delete_files(aip):
     """
 
     # Deletes files if the file extension is not in the keep list.
-    # Using a lowercase version of filename so the match isn't case sensitive.
-    keep = ['.dv', '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.wav', '.pdf', '.xml']
-    for root, directories, files in os.walk(aip):
-        for file in files:
-            if not (any(file.lower().endswith(s) for s in keep)):
-                os.remove(f'{root}/{file}')
-
-    # If deleting the unwanted files left the AIP folder empty, moves the AIP to an error folder.
-    if len(os.listdir(aip)) == 0:
+    # Using a lowercase version of the extension so the match isn't case sensitive.
+    # Counts the files that are kept, so the AIP folder does not need to be read again to see if it is empty.
+    files_kept = 0
+    for entry in scan_files(aip):
+        if os.path.splitext(entry.name)[1].lower() in KEEP_EXTENSIONS:
+            files_kept += 1
+        else:
+            os.remove(entry.path)
+
+    # If deleting the unwanted files left no files in the AIP folder, moves the AIP to an error folder.
+    if files_kept == 0:
         move_error("all_files_deleted", aip)
 
 
@@ -214,23 +285,22 @@ def aip_directory(aip):
     Returns: None
     """
 
-    # Makes the objects folder within the AIP folder, if it doesn't exist. If there is already a folder named objects
-    # in the first level within the AIP folder, moves the AIP to an error folder and ends this function. Do not want
-    # to alter the original directory structure by adding to an original folder named objects.
-    try:
-        os.mkdir(f'{aip}/objects')
-    except FileExistsError:
+    # If there is already a folder named objects in the first level within the AIP folder, moves the AIP to an error
+    # folder and ends this function. Do not want to alter the original directory structure by adding to an original
+    # folder named objects.
+    if os.path.exists(f'{aip}/objects'):
         move_error('preexisting_objects_folder', aip)
         return
 
-    # Moves the contents of the AIP folder into the objects folder.
-    for item in os.listdir(aip):
-        if item == 'objects':
-            continue
-        os.replace(f'{aip}/{item}', f'{aip}/objects/{item}')
+    # Moves the contents of the AIP folder into the objects folder by renaming the AIP folder to objects within a new
+    # AIP folder. This is three renames no matter how many files are in the AIP, instead of one rename per item.
+    # The temporary name starts with the AIP ID so it is unique within the AIPs directory.
+    os.replace(aip, f'{aip}_objects_temp')
+    os.mkdir(aip)
+    os.replace(f'{aip}_objects_temp', f'{aip}/objects')
 
     # Makes the metadata folder within the AIP folder.
-    # Do not have to check if it already exists since everything is moved to the objects folder in the previous step.
+    # Do not have to check if it already exists since the AIP folder was just made.
     os.mkdir(f'{aip}/metadata')
 
 
@@ -248,8 +318,9 @@ def mediainfo(aip):
     # Runs MediaInfo on the contents of the objects folder and saves the XML output to the metadata folder.
     # --'Output=XML' uses the XML structure that started with MediaInfo 18.03
     # --'Language=raw' outputs the size in bytes.
-    subprocess.run(
-        f'mediainfo -f --Output=XML --Language=raw "{aip}/objects" > "{aip}/metadata/{aip}_mediainfo.xml"', shell=True)
+    # The output is written directly to the file instead of using a shell redirect, so no shell process is started.
+    with open(f'{aip}/metadata/{aip}_mediainfo.xml', 'wb') as media_xml:
+        subprocess.run(['mediainfo', '-f', '--Output=XML', '--Language=raw', f'{aip}/objects'], stdout=media_xml)
 
     # Copies the MediaInfo XML to a separate folder (mediainfo-xml) for staff reference.
     # If a file by that name is already in mediainfo-xml,
@@ -260,6 +331,91 @@ def mediainfo(aip):
         shutil.copy2(f'{aip}/metadata/{aip}_mediainfo.xml', 'mediainfo-xml')
 
 
+@lru_cache(maxsize=None)
+def saxon_stylesheet():
+    """Compile the stylesheet for making the preservation.xml with saxonche
+
+    This is cached, so the stylesheet is only compiled the first time it is needed by each worker process.
+
+    Returns:
+        processor: the saxonche processor, which must be kept for as long as the stylesheet is used
+        stylesheet: the compiled mediainfo-to-preservation.xslt
+    """
+
+    processor = PySaxonProcessor(license=False)
+    xslt_processor = processor.new_xslt30_processor()
+    stylesheet = xslt_processor.compile_stylesheet(stylesheet_file=f'{STYLESHEETS}/mediainfo-to-preservation.xslt')
+    return processor, stylesheet
+
+
+def saxon_transform(media_xml, pres_xml, params):
+    """Make the preservation.xml from the MediaInfo XML with the stylesheet compiled by saxonche
+
+    Parameters:
+        media_xml: path to the MediaInfo XML
+        pres_xml: path for saving the preservation.xml
+        params: dictionary of the stylesheet parameter names and values
+
+    Returns: None
+    """
+
+    processor, stylesheet = saxon_stylesheet()
+    stylesheet.clear_parameters()
+    for name, value in params.items():
+        stylesheet.set_parameter(name, processor.make_string_value(str(value)))
+
+    # Paths are made absolute since saxonche does not always use the current directory of the worker process.
+    # If the transformation fails, saxonche prints the error and no preservation.xml is made,
+    # which is caught when the preservation.xml is validated.
+    try:
+        stylesheet.transform_to_file(source_file=os.path.abspath(media_xml), output_file=os.path.abspath(pres_xml))
+    except PySaxonApiError:
+        pass
+
+
+@lru_cache(maxsize=None)
+def preservation_schema():
+    """Read the schema for validating the preservation.xml with lxml
+
+    This is cached, so the schema is only read the first time it is needed by each worker process.
+
+    Returns: the preservation.xsd as an lxml XMLSchema
+    """
+
+    return etree.XMLSchema(etree.parse(f'{STYLESHEETS}/preservation.xsd'))
+
+
+def validate_preservation(pres_xml):
+    """Validate the preservation.xml with lxml if it is installed or otherwise xmllint
+
+    Possible validation errors:
+        preservation.xml was not made (failed to load)
+        preservation.xml does not match the metadata requirements (fails to validate)
+
+    Parameters:
+        pres_xml: path to the preservation.xml
+
+    Returns: list of validation error messages, which is empty if the preservation.xml is valid
+    """
+
+    if etree:
+        schema = preservation_schema()
+        try:
+            document = etree.parse(pres_xml)
+        except (OSError, etree.XMLSyntaxError) as error:
+            return [f'{pres_xml} failed to load: {error}']
+        if schema.validate(document):
+            return []
+        return [str(entry) for entry in schema.error_log] + [f'{pres_xml} fails to validate']
+
+    # xmllint exits with a non-zero code for any error, including a preservation.xml that is not well-formed.
+    validate = subprocess.run(['xmllint', '--noout', '-schema', f'{STYLESHEETS}/preservation.xsd', pres_xml],
+                              stderr=subprocess.PIPE)
+    if validate.returncode != 0:
+        return validate.stderr.decode('utf-8', 'replace').splitlines()
+    return []
+
+
 def preservation_xml(aip_md):
     """Create PREMIS and Dublin Core metadata from the MediaInfo XML and save it as a preservation.xml file
 
@@ -274,173 +430,332 @@ def preservation_xml(aip_md):
     xslt = f'{STYLESHEETS}/mediainfo-to-preservation.xslt'
     pres_xml = f'{aip_md.AIP_ID}/metadata/{aip_md.AIP_ID}_preservation.xml'
 
-    # Arguments to add to the saxon command.
-    args = (f'aip-id={aip_md.AIP_ID} collection-id={aip_md.Collection} department={aip_md.Department} '
-            f'title="{aip_md.Title}" version={aip_md.Version} namespace={NAMESPACE}')
+    # Stylesheet parameters, which are added to the saxon command as arguments.
+    # Each argument is its own list item, so values with spaces or quotes (such as the title) do not need quoting.
+    params = {'aip-id': aip_md.AIP_ID, 'collection-id': aip_md.Collection, 'department': aip_md.Department,
+              'title': aip_md.Title, 'version': aip_md.Version, 'namespace': NAMESPACE}
+    args = [f'{name}={value}' for name, value in params.items()]
 
     # Makes the preservation.xml file from the mediainfo.xml using a stylesheet and saves it to the AIP's metadata
-    # folder. If the mediainfo.xml is not present, moves the AIP to an error folder and ends this function.
-    if os.path.exists(media_xml):
-        subprocess.run(f'java -cp "{SAXON}" net.sf.saxon.Transform -s:"{media_xml}" -xsl:"{xslt}" -o:"{pres_xml}" {args}',
-                       shell=True)
+    # folder, with saxonche if it is installed or otherwise the saxon jar.
+    # If the mediainfo.xml is not present, moves the AIP to an error folder and ends this function.
+    if os.path.exists(media_xml) and PySaxonProcessor:
+        saxon_transform(media_xml, pres_xml, params)
+    elif os.path.exists(media_xml):
+        subprocess.run(SAXON_COMMAND + [f'-s:{media_xml}', f'-xsl:{xslt}', f'-o:{pres_xml}'] + args)
     else:
         move_error('no_mediainfo_xml', aip_md.AIP_ID)
         return
 
     # Validates the preservation.xml against the requirements of the Libraries' digital preservation system (ARCHive).
-    # Possible validation errors:
-    #   preservation.xml was not made (failed to loaded)
-    #   preservation.xml does not match the metadata requirements (fails to validate)
-    validate = subprocess.run(f'xmllint --noout -schema "{STYLESHEETS}/preservation.xsd" "{pres_xml}"',
-                              stderr=subprocess.PIPE, shell=True)
+    validation_errors = validate_preservation(pres_xml)
 
     # If the preservation.xml isn't valid, moves the AIP to an error folder and saves the validation error to a text
     # document in the error folder. If the preservation.xml is valid, copies the preservation.xml to another folder for
     # staff use.
-    if 'failed to load' in str(validate) or 'fails to validate' in str(validate):
+    if validation_errors:
         move_error('preservation_invalid', aip_md.AIP_ID)
         with open(f'errors/preservation_invalid/{aip_md.AIP_ID}_preservationxml_validation_error.txt', 'a') as error:
-            lines = str(validate.stderr).split('\\n')
-            for line in lines:
+            for line in validation_errors:
                 error.write(f'{line}\n\n')
     else:
         shutil.copy2(pres_xml, 'preservation-xml')
 
 
-def package(aip):
+def package(aip, bag_processes):
     """Bag, tar, and zip the AIP and renames the AIP folder to AIPID_bag.
 
     Parameters:
         aip: AIP ID
+        bag_processes: the number of processes bagit uses to calculate checksums
 
     Returns: None
     """
 
-    # Deletes any .DS_Store files because they cause errors with bag validation. They would have been deleted by
-    # delete_files() earlier in the script, but can be regenerated while the script is running.
-    for root, dirs, files in os.walk('.'):
-        for item in files:
-            if item == '.DS_Store':
-                os.remove(f'{root}/{item}')
+    # Deletes any .DS_Store files in the AIP because they cause errors with bag validation. They would have been
+    # deleted by delete_files() earlier in the script, but can be regenerated while the script is running.
+    # Only the AIP being packaged is checked, rather than the entire AIPs directory.
+    for entry in scan_files(aip):
+        if entry.name == '.DS_Store':
+            os.remove(entry.path)
 
-    # Bags the AIP folder in place.
+    # Bags the AIP folder in place, using bagit within Python instead of starting bagit.py for every AIP.
     # Both md5 and sha256 checksums are generated to guard against tampering.
-    subprocess.run(f'bagit.py --md5 --sha256 --quiet "{aip}"', shell=True)
+    # The checksums for different files are calculated at the same time, using bag_processes processes.
+    # If the bag cannot be made, the error is printed and the AIP is moved to an error folder by the bag validation.
+    try:
+        bagit.make_bag(aip, checksums=['md5', 'sha256'], processes=bag_processes)
+    except (bagit.BagError, OSError) as error:
+        print(f'Cannot make bag for {aip}: {error}')
 
     # Renames the AIP folder to add the AIP type and '_bag' to the end.
     # This is saved to a variable first since it is used a few more times in the function.
     bag_name = f'{aip}_bag'
     os.replace(aip, bag_name)
 
-    # Validates the bag. If the bag is not valid, moves the AIP to an error folder, saves the validation error to a
-    # document in the error folder, and ends this function.
-    validate = subprocess.run(f'bagit.py --validate "{bag_name}"', stderr=subprocess.PIPE, shell=True)
-
-    if 'bag is valid' not in str(validate):
+    # Validates the bag with bagit within Python, recalculating the checksums with bag_processes processes.
+    # If the bag is not valid, moves the AIP to an error folder, saves the validation error to a document in the
+    # error folder, and ends this function. The error lists each problem found, separated by semicolons.
+    try:
+        bagit.Bag(bag_name).validate(processes=bag_processes)
+    except bagit.BagError as validation_error:
         move_error('bag_invalid', bag_name)
         with open(f'errors/bag_invalid/{bag_name}_bag_validation_error.txt', 'a') as error:
-            lines = str(validate.stderr).split(';')
-            for line in lines:
+            for line in str(validation_error).split(';'):
                 error.write(f'{line}\n\n')
         return
 
-    # Tars and zips the AIP using a Perl script.
-    # The script also adds the uncompressed file size to the filename.
+    # Tars and zips the AIP, with the uncompressed file size in the filename.
     # The tarred and zipped AIP is saved to the aips-to-ingest folder.
-    subprocess.run(f'perl "{PREPARE_BAG}" "{bag_name}" aips-to-ingest', shell=True)
+    # If a parallel version of bzip2 is installed, it uses the same number of threads as bagit used processes.
+    # If it cannot be made, moves the bag to an error folder and ends this function.
+    if not tar_and_zip(bag_name, 'aips-to-ingest', bag_processes):
+        move_error('tar_zip_failed', bag_name)
+        return
 
     # Adds the AIP to the log for successfully completing, since this function is the last step.
     log(aip, "Complete")
 
 
-# Verifies the required script argument (aips_directory) is correct.
-# If there are any errors, exits the script.
-aips_directory, error_message = check_argument(sys.argv)
-if error_message:
-    print(error_message)
-    print("To run the script: python3 'path/aip_av.py' 'path/aips_directory'")
-    sys.exit()
-
-# Changes the current directory to the AIPs directory.
-os.chdir(aips_directory)
-
-# Reads the metadata.csv (must be in the aips_directory) into a pandas dataframe
-# and verifies it has the expected content. If there are any errors, exits the script.
-aip_metadata_df, errors = metadata_csv(aips_directory)
-if len(errors) > 0:
-    print("Problem with the metadata.csv. Correct the following error(s) and run the script again.")
-    for error_msg in errors:
-        print('\n*', error_msg)
-    sys.exit()
-
-# Starts counts for tracking the script progress.
-total_aips = len(aip_metadata_df.index)
-current_aip = 0
-
-# Makes folders for the script outputs in the AIPs directory, if they don't already exist.
-for directory in ['mediainfo-xml', 'preservation-xml', 'aips-to-ingest']:
-    if not os.path.exists(directory):
-        os.mkdir(directory)
-
-# Makes a log file, with a header row, in the AIPs directory.
-log("AIP_ID", "Status")
-
-# For one AIP at a time (based on the rows in the metadata csv), runs the functions for all workflow steps.
-# If a known error occurs, the AIP is moved to a folder with the error name and the next AIP is started.
-# Checks if the AIP is still present before running each function in case it was moved due to a previous error.
-for aip_row in aip_metadata_df.itertuples():
-
-    # Updates the current AIP number and displays the script progress.
-    current_aip += 1
+def bzip2_command(processes):
+    """Get the command for zipping, using a parallel version of bzip2 if one is installed
+
+    lbzip2 and pbzip2 (both optional) make standard bzip2 files, but compress different parts of the tar at the same
+    time. If neither is installed, bzip2 is used.
+
+    Parameters:
+        processes: the number of threads a parallel version of bzip2 uses
+
+    Returns: the command as a list
+    """
+
+    if shutil.which('lbzip2'):
+        return ['lbzip2', '-n', str(processes)]
+    if shutil.which('pbzip2'):
+        return ['pbzip2', f'-p{processes}']
+    return ['bzip2']
+
+
+def tar_and_zip(bag_name, destination, zip_processes):
+    """Tar and zip the bag, adding the size of the tar to the filename
+
+    The tar is streamed directly into bzip2, instead of saving the tar and then zipping it,
+    so the bag is only read once and the uncompressed tar is never written to disk.
+    The size of the tar is counted while it is streamed and added to the filename once it is done,
+    giving the same filename as the prepare_bag Perl script used previously: AIPID_bag.size.tar.bz2
+
+    Parameters:
+        bag_name: name of the bag folder, which is in the current directory
+        destination: path to the folder for saving the tarred and zipped bag
+        zip_processes: the number of threads used for zipping, if a parallel version of bzip2 is installed
+
+    Returns:
+        True if the tarred and zipped bag was made, or False if tar or bzip2 had an error
+    """
+
+    zip_path = os.path.join(destination, f'{bag_name}.tar.bz2')
+    tar_size = 0
+    with open(zip_path, 'wb') as zip_file:
+        tar_process = subprocess.Popen(['tar', 'cf', '-', bag_name], stdout=subprocess.PIPE)
+        zip_process = subprocess.Popen(bzip2_command(zip_processes), stdin=subprocess.PIPE, stdout=zip_file)
+        try:
+            for chunk in iter(lambda: tar_process.stdout.read(1024 * 1024), b''):
+                tar_size += len(chunk)
+                zip_process.stdin.write(chunk)
+            zip_process.stdin.close()
+        except BrokenPipeError:
+            # bzip2 stopped before reading the whole tar (for example, the disk is full).
+            # Stops tar too, so it is not left waiting to write the rest of the tar.
+            tar_process.kill()
+            try:
+                zip_process.stdin.close()
+            except BrokenPipeError:
+                pass
+        tar_process.stdout.close()
+        tar_process.wait()
+        zip_process.wait()
+
+    # If tar or bzip2 had an error, prints the error and deletes the incomplete file, so it is not included in the
+    # manifest. Otherwise, renames the file to include the size.
+    if tar_process.returncode != 0 or zip_process.returncode != 0:
+        print(f'Cannot create tar and zip file for {bag_name}.')
+        os.remove(zip_path)
+        return False
+    os.replace(zip_path, os.path.join(destination, f'{bag_name}.{tar_size}.tar.bz2'))
+    return True
+
+
+def md5(file_path):
+    """Calculate the MD5 checksum of a file
+
+    The file is read in chunks of 1 MB into one reused buffer, so large packaged AIPs do not have to fit in memory
+    and a new bytes object is not made for every chunk.
+
+    Parameters:
+        file_path: path to the file
+
+    Returns:
+        checksum: the MD5 checksum, as a string of hexadecimal digits
+    """
+
+    md5_hash = hashlib.md5(usedforsecurity=False)
+    buffer = bytearray(1024 * 1024)
+    view = memoryview(buffer)
+    with open(file_path, 'rb', buffering=0) as file:
+        while size := file.readinto(buffer):
+            md5_hash.update(view[:size])
+    checksum = md5_hash.hexdigest()
+    return checksum
+
+
+def process_aip(aip_row, current_aip, total_aips, bag_processes):
+    """Run all the workflow steps for one AIP
+
+    This is run by a worker process, so several AIPs can be processed at the same time.
+    If a known error occurs, the AIP is moved to a folder with the error name and the rest of the steps are skipped.
+    Checks if the AIP is still present before running each function in case it was moved due to a previous error.
+
+    Parameters:
+        aip_row: Data from all columns of the metadata.csv for one AIP
+        current_aip: the number of this AIP in the metadata.csv, for the script progress
+        total_aips: the number of AIPs in the metadata.csv, for the script progress
+        bag_processes: the number of processes bagit uses to calculate checksums
+
+    Returns:
+        aip_log_rows: a list of the rows for the log (AIP ID and message) for this AIP
+    """
+
+    # Starts a new list of log rows, since the worker process may have been used for another AIP.
+    log_rows.clear()
+
+    # Displays the script progress.
     print(f'\n>>>Processing {aip_row.Folder} ({current_aip} of {total_aips}).')
 
     # Renames the AIP folder to the AIP ID.
     os.replace(aip_row.Folder, aip_row.AIP_ID)
 
     # Deletes undesired files based on the file extension.
-    if aip_row.AIP_ID in os.listdir('.'):
+    if os.path.isdir(aip_row.AIP_ID):
         delete_files(aip_row.AIP_ID)
 
     # Organizes the AIP folder contents into the AIP directory structure
     # and renames the AIP folder to the AIP ID.
-    if aip_row.AIP_ID in os.listdir('.'):
+    if os.path.isdir(aip_row.AIP_ID):
         aip_directory(aip_row.AIP_ID)
 
     # Extracts technical metadata from the files using MediaInfo.
-    if aip_row.AIP_ID in os.listdir('.'):
+    if os.path.isdir(aip_row.AIP_ID):
         mediainfo(aip_row.AIP_ID)
 
     # Transforms the MediaInfo XML into the PREMIS preservation.xml file.
-    if aip_row.AIP_ID in os.listdir('.'):
+    if os.path.isdir(aip_row.AIP_ID):
         preservation_xml(aip_row)
 
     # Bags the AIP, validates the bag, and tars and zips the AIP.
-    if aip_row.AIP_ID in os.listdir('.'):
-        package(aip_row.AIP_ID)
-
-# Makes a MD5 manifest of all packaged AIPs for each department in the aips-to-ingest folder using md5sum.
-# The manifest has one line per AIP, formatted md5<tab>filename
-# Change the current directory to aips-to-ingest so that no path information is included with the filename.
-os.chdir('aips-to-ingest')
-current_date = datetime.datetime.now().strftime("%Y-%m-%d-%H%M")
-# Checks that aips-to-ingest is not empty (due to script errors) before making the manifest.
-if not len(os.listdir()) == 0:
-    for file in os.listdir():
-
-        # Runs md5sum and extracts the desired information (md5 filename) from the md5sum output.
-        md5sum_output = subprocess.run(f"md5sum {file}", stdout=subprocess.PIPE, shell=True)
-        fixity = bytes.decode(md5sum_output.stdout).strip()
-
-        # Saves the fixity information to the correct department manifest.
+    if os.path.isdir(aip_row.AIP_ID):
+        package(aip_row.AIP_ID, bag_processes)
+
+    return list(log_rows)
+
+
+# Guards the script steps, so they are not run again when the worker processes import this script.
+if __name__ == '__main__':
+
+    # Verifies the required script argument (aips_directory) is correct.
+    # If there are any errors, exits the script.
+    aips_directory, error_message = check_argument(sys.argv)
+    if error_message:
+        print(error_message)
+        print("To run the script: python3 'path/aip_av.py' 'path/aips_directory'")
+        sys.exit()
+
+    # Changes the current directory to the AIPs directory.
+    os.chdir(aips_directory)
+
+    # Reads the metadata.csv (must be in the aips_directory) into a pandas dataframe
+    # and verifies it has the expected content. If there are any errors, exits the script.
+    aip_metadata_df, errors = metadata_csv(aips_directory)
+    if len(errors) > 0:
+        print("Problem with the metadata.csv. Correct the following error(s) and run the script again.")
+        for error_msg in errors:
+            print('\n*', error_msg)
+        sys.exit()
+
+    # Total count for tracking the script progress.
+    total_aips = len(aip_metadata_df.index)
+
+    # Makes folders for the script outputs in the AIPs directory, if they don't already exist.
+    for directory in ['mediainfo-xml', 'preservation-xml', 'aips-to-ingest']:
+        os.makedirs(directory, exist_ok=True)
+
+    # Calculates how many worker processes to use for processing AIPs: one per CPU, but no more than the number of
+    # AIPs. Any CPUs left over are shared by the workers for calculating bag checksums, so small batches still use
+    # every CPU without starting more processes than there are CPUs when the batch is large.
+    # os.cpu_count() returns None if the number of CPUs cannot be found, in which case one CPU is assumed.
+    cpus = os.cpu_count() or 1
+    workers = max(1, min(cpus, total_aips))
+    bag_processes = max(1, cpus // workers)
+
+    # Makes a log file, with a header row, in the AIPs directory, which is opened once and kept open while the AIPs
+    # are processed. The rows returned by each worker are saved as soon as that AIP is done,
+    # so the log is up to date even if the script stops early.
+    # For each AIP (based on the rows in the metadata csv), runs the functions for all workflow steps.
+    # The AIPs are independent of each other and most of the time is spent waiting on other programs
+    # (MediaInfo, saxon, bagit, tar and zip), so AIPs are processed at the same time in a pool of worker processes.
+    # Each worker starts in the AIPs directory, since the workflow steps use paths relative to it.
+    # The rows are read as plain tuples and made into AIPRow, since the rows made by itertuples() cannot be pickled.
+    # If a worker stops with an unexpected error, the error is printed and added to the log for that AIP,
+    # and the script continues so the rest of the log and the manifests are still made.
+    aip_rows = map(AIPRow._make, aip_metadata_df.itertuples(index=False, name=None))
+    with open('log.csv', 'a', newline='') as log_file:
+        log_writer = csv.writer(log_file)
+        log_writer.writerow(["AIP_ID", "Status"])
+        log_file.flush()
+        with ProcessPoolExecutor(max_workers=workers, initializer=os.chdir, initargs=(os.getcwd(),)) as executor:
+            futures = {executor.submit(process_aip, aip_row, current_aip, total_aips, bag_processes): aip_row
+                       for current_aip, aip_row in enumerate(aip_rows, start=1)}
+            for future in as_completed(futures):
+                try:
+                    log_writer.writerows(future.result())
+                except Exception as error:
+                    print(f'\nUnexpected error processing {futures[future].Folder}: {error}')
+                    log_writer.writerow([futures[future].AIP_ID, f'Unexpected error: {error}'])
+                log_file.flush()
+
+    # Makes a MD5 manifest of all packaged AIPs for each department in the aips-to-ingest folder.
+    # This is done after all workers are finished, so every packaged AIP is included.
+    # The manifest has one line per AIP, formatted md5<two spaces>filename, the same as md5sum.
+    # Change the current directory to aips-to-ingest so that no path information is included with the filename.
+    os.chdir('aips-to-ingest')
+    current_date = datetime.datetime.now().strftime("%Y-%m-%d-%H%M")
+    # Reads the contents of aips-to-ingest once, and checks it is not empty (due to script errors)
+    # before making the manifest.
+    packaged_aips = os.listdir()
+    if not len(packaged_aips) == 0:
+
+        # Sorts the packaged AIPs by the department manifest they belong in.
+        # Files that are not in a department manifest are skipped, so their checksum is not calculated.
+        manifest_files = {department: [] for department in DEPARTMENT_PREFIXES.values()}
+        for file in packaged_aips:
+            department = next((dept for prefix, dept in DEPARTMENT_PREFIXES.items() if file.startswith(prefix)), None)
+            if department:
+                manifest_files[department].append(file)
+
+        # Calculates the MD5 in Python, rather than starting a md5sum process for each file.
+        # Several files are hashed at the same time with threads, since hashlib releases the GIL while hashing.
+        manifest_lines = {}
+        with ThreadPoolExecutor(max_workers=cpus) as executor:
+            for department, files in manifest_files.items():
+                manifest_lines[department] = [f'{checksum}  {file}\n'
+                                              for file, checksum in zip(files, executor.map(md5, files))]
+
+        # Saves the fixity information to each department manifest, opening each manifest once.
         # The manifest is named current-date_department_manifest.txt and saved in the aips-to-ingest folder.
-        if file.startswith("har"):
-            with open(f"{current_date}_hargrett_manifest.txt", "a") as manifest:
-                manifest.write(f"{fixity}\n")
-        elif file.startswith("rbrl"):
-            with open(f"{current_date}_russell_manifest.txt", "a") as manifest:
-                manifest.write(f"{fixity}\n")
-else:
-    print('\nCould not make manifest. aips-to-ingest is empty.')
-
+        for department, lines in manifest_lines.items():
+            if len(lines) > 0:
+                with open(f"{current_date}_{department}_manifest.txt", "a") as manifest:
+                    manifest.writelines(lines)
+    else:
+        print('\nCould not make manifest. aips-to-ingest is empty.')
 
-print('\nScript is finished running.')
+    print('\nScript is finished running.')
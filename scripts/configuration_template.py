@@ -11,7 +11,6 @@ To use, make a copy of this file named configuration.py and update the paths to
 # Script tested with SaxonHE10.1.
 SAXON = 'C:/INSERT-PATH/saxon-he-##.#.jar'
 STYLESHEETS = 'C:/INSERT-PATH/stylesheets'
-PREPARE_BAG = 'C:/INSERT-PATH/prepare_bag'
 
 # Namespace for AIP identifiers. For UGA, this is the URI for ARCHive.
 NAMESPACE = 'INSERT-NAMESPACE'